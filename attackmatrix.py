@@ -12,10 +12,20 @@
 #
 
 import argparse
+import array
 import collections
+import concurrent.futures
+import email.utils
+import functools
+import gzip
+import hashlib
+import hmac
+import http.client
 import itertools
 import logging
 import json
+import orjson
+import os
 import pathlib
 import pprint
 import re
@@ -23,13 +33,16 @@ import requests
 import shutil
 import string
 import sys
+import tempfile
+import time
 import urllib.request
-import uvicorn
 import yaml
 from config import settings as options
 from config.matrixtable import Matrices
-from fastapi import FastAPI, HTTPException, Request, Query
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi import Depends, FastAPI, HTTPException, Request, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, RedirectResponse, Response, StreamingResponse
 from typing import Optional
 
 
@@ -62,6 +75,13 @@ typemap = {
     'x-mitre-data-source': 'Data Sources',
     'x-mitre-tactic': 'Tactics',
 }
+# STIX external_references source names that carry an object's ATT&CK ID
+mitresources = frozenset([
+    'mitre-attack',
+    'mitre-ics-attack',
+    'mitre-mobile-attack',
+    'mitre-pre-attack',
+])
 categories=[
     'Actors',
     'Campaigns',
@@ -76,6 +96,18 @@ categories=[
     'Techniques',
     'Tools',
 ]
+# Parsed cachefile, kept for the lifetime of the process and keyed on
+# (path, mtime) so loadCache() can tell when it has been regenerated
+caches = {}
+# The process umask, which can only be read by setting it: read once at import,
+# before any download threads run, for files created via NamedTemporaryFile()
+umask = os.umask(0)
+os.umask(umask)
+# getCache() stats the cachefile at most once per this many seconds
+cachecheckinterval = 5
+cachechecked = None
+# Lookup tables and ETag derived from the cache whenever it is (re)loaded
+indexes = {}
 tags_metadata = [
     {
         'name': 'docs',
@@ -138,8 +170,35 @@ tags_metadata = [
                        ' to find which *Actors* use use *Techniques T1078, T1588.002 and T1574* and *Tools S0002, S0008'
                        ' and S0032*.',
     },
+    {
+        'name': 'admin',
+        'description': 'Reloads the cachefile and rebuilds the search indexes, e.g. after the matrices have been '
+                       'regenerated. Only available when a token is configured.',
+    },
 ]
-app = FastAPI(title='MITRE ATT&CK Matrix API', openapi_tags=tags_metadata)
+app = FastAPI(title='MITRE ATT&CK Matrix API', openapi_tags=tags_metadata, default_response_class=ORJSONResponse)
+# Explore results can easily be several megabytes of JSON
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+def checkToken(token: Optional[str] = None):
+    if options.token:
+        if token is None or not hmac.compare_digest(token.encode(), str(options.token).encode()):
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+
+
+def requireToken(token: Optional[str] = None):
+    '''
+    Like checkToken(), but for the admin endpoints: disabled without a token
+    '''
+    if not options.token:
+        raise HTTPException(status_code=403, detail='Access denied: configure a token to use the admin endpoints')
+    checkToken(token)
+
+
+@app.on_event('startup')
+async def warmCache():
+    loadCache(options)
+
 
 @app.get('/', tags=['docs'])
 async def read_root():
@@ -151,74 +210,105 @@ async def read_api():
     return RedirectResponse('/docs')
 
 
-@app.get('/api/explore/{treepath:path}', tags=['explore'])
-async def query(request: Request,
-                token: Optional[str] = None):
-    if options.token:
-        if token != options.token:
-            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+@app.get('/api/explore/{treepath:path}', tags=['explore'], dependencies=[Depends(checkToken)])
+async def query(request: Request):
+    cache = getCache(options)
+    # Explore results only change when the cachefile does
+    etag = indexes.get('ETag')
+    # If-None-Match uses weak comparison: a proxy that gzips the response
+    # sends back our ETag as W/"...", and '*' matches any current version
+    tags = [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]
+    if etag and ('*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]):
+        return Response(status_code=304, headers={'ETag': etag})
+    treepath = [i for i in request.path_params['treepath'].split('/') if i]
     try:
         results = {}
-        cache = loadCache(options)
-        if not request.path_params['treepath']:
+        if not treepath:
             results = {
                 'Metadata': {
                     'name': 'AttackMatrix API',
-                    'description': 'Available keys: ' + ', '.join(key for key in cache),
+                    'description': 'Available keys: ' + ', '.join(cache),
                     'matrices': cache['Matrices'],
                 },
             }
         else:
-            treepath = request.path_params['treepath'].split('/')
-            treepath = [i for i in treepath if i]
-            results = cache[treepath[0]][treepath[1]] if len(treepath)>1 else cache[treepath[0]]
-    except KeyError as e:
+            results = cache
+            for key in treepath:
+                results = results[key]
+    except (KeyError, TypeError) as e:
         results = {
             'error': 'Key does not exist: '+str(e),
         }
     finally:
-        return JSONResponse(results)
+        headers = {'ETag': etag} if etag else None
+        if len(treepath) == 1 and isinstance(results, dict):
+            # A whole category is megabytes of JSON: stream it entity by entity
+            return StreamingResponse(streamJSON(results), media_type='application/json', headers=headers)
+        return ORJSONResponse(results, headers=headers)
 
 
-@app.get('/api/search', tags=['search'])
+def streamJSON(results, chunksize=1024*1024):
+    '''
+    Serialize a dict one key at a time, so a large explore result never has
+    to be rendered in one piece (sync, so Starlette runs it in a threadpool).
+    Entities are batched into chunks of about chunksize bytes: every chunk
+    costs a threadpool round trip and a separate gzip pass
+    '''
+    chunk = [b'{']
+    size = 1
+    for count, (key, value) in enumerate(results.items()):
+        entity = (b',' if count else b'') + orjson.dumps(key) + b':' + \
+            orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        chunk.append(entity)
+        size += len(entity)
+        if size >= chunksize:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(b'}')
+    yield b''.join(chunk)
+
+
+@app.get('/api/search', tags=['search'], dependencies=[Depends(checkToken)])
 async def searchParam(request: Request,
-                      params: list = Query([]),
-                      token: Optional[str] = None):
-    if options.token:
-        if token != options.token:
-            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+                      params: list = Query([])):
     return search(options, params)
 
-@app.get('/api/actoroverlap', tags=['actoroverlap'])
+@app.get('/api/actoroverlap', tags=['actoroverlap'], dependencies=[Depends(checkToken)])
 async def actorOverlap(request: Request,
-                       actors: list = Query([]),
-                       token: Optional[str] = None):
-    if options.token:
-        if token != options.token:
-            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+                       actors: list = Query([])):
     return findActorOverlap(options, actors)
 
 
-@app.get('/api/ttpoverlap', tags=['ttpoverlap'])
+@app.get('/api/ttpoverlap', tags=['ttpoverlap'], dependencies=[Depends(checkToken)])
 async def ttpOverlap(request: Request,
-                     ttps: list = Query([]),
-                     token: Optional[str] = None):
-    if options.token:
-        if token != options.token:
-            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+                     ttps: list = Query([])):
     return findTTPOverlap(options, ttps)
 
 
-@app.get('/api/findactor', tags=['findactor'])
+@app.get('/api/findactor', tags=['findactor'], dependencies=[Depends(checkToken)])
 async def findActor(request: Request,
-                     ttps: list = Query([]),
-                     token: Optional[str] = None):
-    if options.token:
-        if token != options.token:
-            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+                     ttps: list = Query([])):
     return findActorByTTPs(options, ttps)
 
 
+@app.post('/api/admin/reload', tags=['admin'], dependencies=[Depends(requireToken)])
+async def reload(request: Request):
+    # Parsing and indexing takes seconds: keep it off the event loop, and
+    # keep serving the current cache if the cachefile turns out to be bad
+    loaded = await run_in_threadpool(readCache, options)
+    if not loaded:
+        return {
+            'error': 'Error loading the cachefile ' + pathlib.Path(options.cachefile).name,
+            'count': 0,
+        }
+    publishCache(*loaded)
+    return {
+        'message': 'Cache reloaded',
+        'count': len(indexes['Entities']),
+    }
+
+
 def findActorOverlap(options, actors=[]):
     try:
         response = {}
@@ -228,43 +318,28 @@ def findActorOverlap(options, actors=[]):
                 'count': 0,
             }
         else:
-            cache = loadCache(options)
+            cache = getCache(options)
             response = collections.defaultdict(lambda: {}, {})
-            ttps = {}
             actors = [actor.upper() for actor in actors]
-            # Build a list of all TTPs of all actors (OR)
             for actor in actors:
                 response[actor] = {}
-                if actor in cache['Actors']:
-                    for category in categories:
-                        if category in cache['Actors'][actor]:
-                            for ttp in cache['Actors'][actor][category]:
-                                if not category in ttps:
-                                    ttps[category] = {}
-                                ttps[category][ttp] = cache['Actors'][actor][category][ttp]
-                else:
+                if not actor in cache['Actors']:
                     response = {
                         'error': 'AttackMatrix: actor '+actor+' does not exist!',
                         'count': 0,
                     }
                     return response
-            # Wipe TTP categories and types that do not appear in all actors
+            # Only keep the TTPs that appear in all actors
+            actorttps = indexes['ActorTTPs']
+            first = cache['Actors'][actors[0]]
+            commoncategories = actorttps[actors[0]].keys()
+            for actor in actors[1:]:
+                commoncategories &= actorttps[actor].keys()
             commonttps = {}
-            for ttpcategory in ttps:
-                commonttps[ttpcategory] = {}
-                for ttp in ttps[ttpcategory]:
-                    # First, assume the TTP is valid
-                    exists = True
-                    for actor in actors:
-                        if not ttpcategory in cache['Actors'][actor]:
-                            # If the TTP category does not exist for that actor, it is not a valid TTP
-                            exists = False
-                        else:
-                            if not ttp in cache['Actors'][actor][ttpcategory]:
-                                # If the TTP does not exist for an actor, it is not a valid TTP
-                                exists = False
-                    if exists:
-                        commonttps[ttpcategory][ttp] = cache['Actors'][actor][ttpcategory][ttp]
+            for ttpcategory in actorttps[actors[0]]:
+                if ttpcategory in commoncategories:
+                    common = frozenset.intersection(*(actorttps[actor][ttpcategory] for actor in actors))
+                    commonttps[ttpcategory] = {ttp: first[ttpcategory][ttp] for ttp in first[ttpcategory] if ttp in common}
             count = 0
             for actor in actors:
                 for ttpcategory in commonttps:
@@ -291,19 +366,10 @@ def findTTPOverlap(options, ttps=[]):
                 'count': 0,
             }
         else:
-            cache = loadCache(options)
+            cache = getCache(options)
             response = {}
-            ttps = [ttp.upper() for ttp in ttps]
-            for actor in cache['Actors']:
-                actorttps = []
-                response[actor] = {}
-                for category in categories:
-                    if category in cache['Actors'][actor]:
-                        actorttps += list(cache['Actors'][actor][category])
-                if set(ttps).issubset(actorttps):
-                    response[actor] = cache['Actors'][actor]
-                else:
-                    del response[actor]
+            for actor in matchActors([ttp.upper() for ttp in ttps]):
+                response[actor] = cache['Actors'][actor]
     except Exception as e:
         response = {
             'error': 'Python Error: '+str(type(e))+': '+str(e),
@@ -322,45 +388,32 @@ def findActorByTTPs(options, ttps=[]):
                 'count': 0,
             }
         else:
-            cache = loadCache(options)
+            cache = getCache(options)
             response = collections.OrderedDict()
             ttps = [ttp.upper() for ttp in ttps]
             num_given_ttps = len(ttps)
             slices = list(reversed([_ for _ in sorted(list(map(ttps.__getitem__, itertools.starmap(slice, itertools.combinations(range(len(ttps)+1), 2)))), key=len) if len(_)>=options.numttpmatch]))
-            if len(slices):
-                for subset in slices:
-                    searchterms = '&ttps='.join([urllib.parse.quote(_) for _ in subset])
-                    if re.search(r"[\w\s,.\+\-]+", searchterms):
-                        result = findTTPOverlap(options,subset)
-                        if len(result):
-                            for actor in result.keys():
-                                if not actor in response:
-                                    num_known_ttps = 0
-                                    for category in categories:
-                                        if category in result[actor]:
-                                            num_known_ttps += len(result[actor][category])
-                                    response[actor] = {
-                                        'id': actor,
-                                        'name': ', '.join(result[actor]['Metadata']['name']),
-                                        'matching_ttps': subset,
-                                        'num_matching_ttps': len(subset),
-                                        'num_given_ttps': num_given_ttps,
-                                        'num_known_ttps': num_known_ttps,
-                                        'matching_coverage': '%.2f' % ((len(subset)/num_given_ttps)*100) + '%',
-                                        'total_coverage': '%.2f' % ((len(subset)/num_known_ttps)*100) + '%'
-                                    }
-                                else:
-                                    if len(subset) > response[actor]['num_matching_ttps']:
-                                        response[actor] = {
-                                            'id': actor,
-                                            'name': ', '.join(result[actor]['Metadata']['name']),
-                                            'matching_ttps': subset,
-                                            'num_matching_ttps': len(subset),
-                                            'num_given_ttps': num_given_ttps,
-                                            'num_known_ttps': num_known_ttps,
-                                            'matching_coverage': '%.2f' % ((len(subset)/num_given_ttps)*100) + '%',
-                                            'total_coverage': '%.2f' % ((len(subset)/num_known_ttps)*100) + '%'
-                                        }
+            # Slices are ordered longest first, so the first slice an actor
+            # matches is its best one; the records are built afterwards
+            matches = collections.OrderedDict()
+            for subset in slices:
+                searchterms = '&ttps='.join([urllib.parse.quote(_) for _ in subset])
+                if re.search(r"[\w\s,.\+\-]+", searchterms):
+                    for actor in matchActors(subset):
+                        if not actor in matches:
+                            matches[actor] = subset
+            for actor, subset in matches.items():
+                num_known_ttps = sum(len(ttps) for ttps in indexes['ActorTTPs'][actor].values())
+                response[actor] = {
+                    'id': actor,
+                    'name': ', '.join(cache['Actors'][actor]['Metadata']['name']),
+                    'matching_ttps': subset,
+                    'num_matching_ttps': len(subset),
+                    'num_given_ttps': num_given_ttps,
+                    'num_known_ttps': num_known_ttps,
+                    'matching_coverage': '%.2f' % ((len(subset)/num_given_ttps)*100) + '%',
+                    'total_coverage': '%.2f' % ((len(subset)/num_known_ttps)*100) + '%'
+                }
             if len(response):
                 response['count'] = len(response)
                 return response
@@ -373,6 +426,18 @@ def findActorByTTPs(options, ttps=[]):
         return response
 
 
+def matchActors(ttps):
+    '''
+    Return the sorted IDs of all Actors that use every TTP in ttps
+    '''
+    ttps = set(ttps)
+    if not ttps or not indexes['TTPs'].keys() >= ttps:
+        return []
+    # Intersect the actor sets of all TTPs, starting with the smallest
+    postings = sorted((indexes['TTPs'][ttp] for ttp in ttps), key=len)
+    return sorted(postings[0].intersection(*postings[1:]))
+
+
 def search(options, params=[]):
     try:
         response = {}
@@ -382,16 +447,26 @@ def search(options, params=[]):
                 'count': 0,
             }
         else:
-            cache = loadCache(options)
+            cache = getCache(options)
             response = collections.defaultdict(lambda: {})
-            for category in categories:
-                for object in cache[category]:
-                    metadata = cache[category][object]['Metadata']
-                    contents = ' '.join(metadata['name'])
-                    contents += ' '.join(metadata['description'])
-                    contents += ' '.join(metadata['url'])
-                    if all(term.lower() in contents.lower() for term in params):
-                        response[category][object] = cache[category][object]
+            # Only entities containing every trigram of every search term can
+            # match; terms shorter than a trigram do not narrow the search
+            terms = [term.casefold() for term in params]
+            entities = indexes['Entities']
+            contents = indexes['Contents']
+            trigrams = indexes['Trigrams']
+            # The shortest posting list bounds the candidates; the substring
+            # test below covers all the other trigrams and terms
+            candidates = range(len(entities))
+            for term in terms:
+                for i in range(len(term)-2):
+                    posting = trigrams.get(term[i:i+3], ())
+                    if len(posting) < len(candidates):
+                        candidates = posting
+            for number in candidates:
+                if all(term in contents[number] for term in terms):
+                    category, object = entities[number]
+                    response[category][object] = cache[category][object]
             response['count'] = sum(len(response[item]) for item in response)
     except Exception as e:
         response = {
@@ -402,23 +477,145 @@ def search(options, params=[]):
         return response
 
 
+def getCache(options):
+    '''
+    Return the loaded cache, picking up a regenerated cachefile (e.g. after
+    'attackmatrix.py -f') without statting it on every request
+    '''
+    global cachechecked
+    cache = next(iter(caches.values()), None)
+    now = time.monotonic()
+    # Also throttled without a cache, so a bad cachefile isn't re-parsed on
+    # every request
+    if cachechecked is None or now - cachechecked >= cachecheckinterval:
+        cachechecked = now
+        # Keep serving the current cache if the cachefile can't be loaded
+        cache = loadCache(options) or cache
+    return cache
+
+
 def loadCache(options):
+    '''
+    Return the cache, (re)loading it if the cachefile changed since it was
+    last loaded; a cachefile that fails to load leaves the current one in place
+    '''
     cachefile = pathlib.Path(options.cachefile)
-    if options.verbose:
-        logging.info('Loading cache ' + cache.name + '...')
     try:
-        with open(cachefile, 'r') as cache:
-            return json.loads(cache.read())
-    except (ValueError, FileNotFoundError):
+        key = (str(cachefile), cachefile.stat().st_mtime)
+    except FileNotFoundError:
         if options.verbose:
             logging.error('Error loading the cachefile ' + cachefile.name)
+        return None
+    if key in caches:
+        return caches[key]
+    loaded = readCache(options)
+    if loaded:
+        publishCache(*loaded)
+        return loaded[1]
 
 
-def GenerateMatrix(options):
-    merged = collections.defaultdict(lambda: dict())
+def readCache(options):
+    '''
+    Parse the cachefile and build its indexes without touching the ones being
+    served, returning (key, cache, indexes), or None if it can't be loaded
+    '''
+    cachefile = pathlib.Path(options.cachefile)
+    try:
+        key = (str(cachefile), cachefile.stat().st_mtime)
+        if options.verbose:
+            logging.info('Loading cache ' + cachefile.name + '...')
+        contents = cachefile.read_bytes()
+        cache = orjson.loads(contents)
+        cacheindexes = buildIndexes(cache)
+        cacheindexes['ETag'] = '"' + hashlib.blake2b(contents, digest_size=8).hexdigest() + '"'
+        return key, cache, cacheindexes
+    except (ValueError, KeyError, TypeError, AttributeError):
+        # Unparseable, or parseable but not shaped like a cache. Regenerating
+        # is left to the CLI (see checkCache()): API workers racing each
+        # other to rewrite the cachefile could clobber it
+        logging.error('Corrupt cachefile ' + cachefile.name + ', regenerate it with -f')
+    except FileNotFoundError:
+        if options.verbose:
+            logging.error('Error loading the cachefile ' + cachefile.name)
+
+
+def publishCache(key, cache, cacheindexes):
+    '''
+    Swap a fully loaded cache and its indexes in together
+    '''
+    caches.clear()
+    caches[key] = cache
+    indexes.clear()
+    indexes.update(cacheindexes)
+
+
+def buildIndexes(cache):
+    '''
+    Build the inverted indexes used by the query functions:
+    - TTPs: TTP ID -> frozenset() of Actor IDs that use it
+    - ActorTTPs: Actor ID -> category -> frozenset() of the actor's TTP IDs
+    - Entities: list of all searchable (category, ID) pairs, sorted; the
+      position in this list is the entity's number in the other indexes
+    - Contents: list of casefolded search contents, by entity number
+    - Trigrams: casefolded trigram -> sorted array() of the numbers of the
+      entities whose search contents contain it
+    '''
+    ttps = collections.defaultdict(set)
+    actorttps = {}
+    for actor, record in cache['Actors'].items():
+        actorttps[actor] = {}
+        for category in categories:
+            if category in record:
+                actorttps[actor][category] = frozenset(record[category])
+                for ttp in record[category]:
+                    ttps[ttp].add(actor)
+    entities = []
+    contents = []
+    # Postings as arrays of 32-bit entity numbers: a fraction of the memory
+    # of sets of tuples, and sorted since entities are numbered in order
+    trigrams = collections.defaultdict(lambda: array.array('I'))
     for category in categories:
-        merged[category] = {}
-        merged[category]['UIDs'] = {}
+        for object in sorted(cache[category]):
+            number = len(entities)
+            entities.append((category, object))
+            text = searchContents(cache[category][object]['Metadata']).casefold()
+            contents.append(text)
+            for trigram in set(text[i:i+3] for i in range(len(text)-2)):
+                trigrams[trigram].append(number)
+    return {
+        'TTPs': {ttp: frozenset(actors) for ttp, actors in ttps.items()},
+        'ActorTTPs': actorttps,
+        'Entities': entities,
+        'Contents': contents,
+        'Trigrams': dict(trigrams),
+    }
+
+
+def searchContents(metadata):
+    contents = ' '.join(metadata['name'])
+    contents += ' '.join(metadata['description'])
+    contents += ' '.join(metadata['url'])
+    return contents
+
+
+@functools.lru_cache(maxsize=None)
+def fightID(id):
+    '''
+    Strip the FiGHT™ prefixes from an ID, e.g. FGT1234 -> T1234; every
+    distinct ID is only normalized once, no matter how often it is referenced
+    '''
+    return id.upper().replace('FG','').replace('ID','')
+
+
+def GenerateMatrix(options):
+    # Every category (Matrices included) exists up front, so no lookup needs
+    # a defaultdict fallback
+    merged = {category: {} for category in categories}
+    # (Sub)object UID -> (category, MITRE ID), used to resolve relationships
+    uids = {}
+    # Every matrix file is parsed once; the objects needed for building the
+    # relationships are kept here for the second pass
+    parsed = {}
     for matrix in Matrices:
         matrixfile = pathlib.Path(options.cachedir+'/'+Matrices[matrix]['file'])
         if not matrixfile.exists():
@@ -429,16 +626,18 @@ def GenerateMatrix(options):
             matrixdescription = Matrices[matrix]['description']
             matrixtype = Matrices[matrix]['type']
             matrixurl = Matrices[matrix]['url']
-            merged['Matrices'][matrix] = {'Metadata': {
-                    'name': [matrixname],
-                    'description': [matrixdescription],
-                    'url': [matrixurl],
-            }}
+            matrixmetadata = {
+                'name': [matrixname],
+                'description': [matrixdescription],
+                'url': [matrixurl],
+            }
+            merged['Matrices'][matrix] = {'Metadata': matrixmetadata}
             if matrixtype == 'unprotectit':
-                with open(matrixfile, 'r') as f:
-                    contents = json.loads(f.read())
+                with open(matrixfile, 'rb') as f:
+                    contents = orjson.loads(f.read())
                     if 'techniques' in contents:
                         objects = contents['techniques']
+                parsed[matrix] = objects
                 try:
                     for object in objects:
                         ids = object['unprotect_id'].replace(' ','').split(',')
@@ -456,22 +655,16 @@ def GenerateMatrix(options):
                                 for url in object['resources'].split('\r\n'):
                                     objecturls.append(url)
                                 type = 'Techniques'
-                                if not mitreid in merged[type]:
-                                    merged[type][mitreid] = {}
-                                merged[type][mitreid]['Metadata'] = {
+                                entry = merged[type].setdefault(mitreid, {})
+                                entry['Metadata'] = {
                                     'name': objectnames,
                                     'description': objectdescriptions,
                                     'url': objecturls,
                                 }
                                 # Add the matrix to the ID
-                                if 'Matrices' not in merged[type][mitreid]:
-                                    merged[type][mitreid]['Matrices'] = {}
-                                if not matrix in merged[type][mitreid]['Matrices']:
-                                    merged[type][mitreid]['Matrices'][matrix] = merged['Matrices'][matrix]['Metadata']
+                                entry.setdefault('Matrices', {}).setdefault(matrix, matrixmetadata)
                                 # Add the UID to the list
-                                merged[type]['UIDs'][mitreid] = mitreid
-                                if not mitreid in merged[type]:
-                                    merged[type][mitreid] = {}
+                                uids[mitreid] = (type, mitreid)
                                 subobject = 1
                                 if 'snippets' in object:
                                     for snippet in object['snippets']:
@@ -482,20 +675,16 @@ def GenerateMatrix(options):
                                             objecturls = [snippet['technique']]
                                         if 'description' in snippet:
                                             objectdescriptions = [object['description']]
-                                        if not mitresubid in merged[type]:
-                                            merged[type][mitresubid] = {}
-                                        merged[type][mitresubid]['Metadata'] = {
+                                        entry = merged[type].setdefault(mitresubid, {})
+                                        entry['Metadata'] = {
                                             'name': objectnames,
                                             'description': objectdescriptions,
                                             'url': objecturls,
                                         }
                                         # Add the matrix to the ID
-                                        if 'Matrices' not in merged[type][mitresubid]:
-                                            merged[type][mitresubid]['Matrices'] = {}
-                                        if not matrix in merged[type][mitresubid]['Matrices']:
-                                            merged[type][mitresubid]['Matrices'][matrix] = merged['Matrices'][matrix]['Metadata']
+                                        entry.setdefault('Matrices', {}).setdefault(matrix, matrixmetadata)
                                         # Add the UID to the list
-                                        merged[type]['UIDs'][mitresubid] = mitresubid
+                                        uids[mitresubid] = (type, mitresubid)
                                         subobject += 1
                                 subobject = 1
                                 if 'detection_rules' in object:
@@ -505,20 +694,16 @@ def GenerateMatrix(options):
                                         objectnames = [detection_rule['name']]
                                         objectdescriptions = [detection_rule['type']['syntax_lang'].upper()+' detection rule for '+detection_rule['name']]
                                         objecturls = ['https://unprotect.it/api/techniques/'+objectid]
-                                        if not mitresubid in merged[type]:
-                                            merged[type][mitresubid] = {}
-                                        merged[type][mitresubid]['Metadata'] = {
+                                        entry = merged[type].setdefault(mitresubid, {})
+                                        entry['Metadata'] = {
                                             'name': objectnames,
                                             'description': objectdescriptions,
                                             'url': objecturls,
                                         }
                                         # Add the matrix to the ID
-                                        if 'Matrices' not in merged[type][mitresubid]:
-                                            merged[type][mitresubid]['Matrices'] = {}
-                                        if not matrix in merged[type][mitresubid]['Matrices']:
-                                            merged[type][mitresubid]['Matrices'][matrix] = merged['Matrices'][matrix]['Metadata']
+                                        entry.setdefault('Matrices', {}).setdefault(matrix, matrixmetadata)
                                         # Add the UID to the list
-                                        merged[type]['UIDs'][mitresubid] = mitresubid
+                                        uids[mitresubid] = (type, mitresubid)
                                         subobject += 1
                             if 'attack' in mitreid:
                                 print(mitreid)
@@ -526,15 +711,16 @@ def GenerateMatrix(options):
                     print("Failed to parse a Unprotect.it object:")
                     pprint.pprint(object)
                     raise
-            if matrixtype == 'yaml':
+            elif matrixtype == 'yaml':
                 with open(matrixfile, 'r') as f:
                     objects = yaml.safe_load(f.read())
+                parsed[matrix] = objects
                 try:
                     for type in objects:
                         if type.title() in categories:
                             for object in objects[type]:
-                                if object['object-type'] in typemap:
-                                    type = typemap[object['object-type']]
+                                type = typemap.get(object['object-type'])
+                                if type:
                                     objectnames = object['name']
                                     objectdescriptions = object['description']
                                     objecturls = object['references'] if 'references' in object else [] 
@@ -543,281 +729,318 @@ def GenerateMatrix(options):
                                         'description': [object['description']],
                                         'url': objecturls,
                                     }
-                                    mitreid = object['id'].lower().replace('fg','').replace('id','').upper()
+                                    mitreid = fightID(object['id'])
                                     uid = mitreid
-                                    if not mitreid in merged[type]:
-                                        merged[type][mitreid] = {}
-                                    if not 'Metadata' in merged[type][mitreid]:
-                                        merged[type][mitreid]['Metadata'] = objectmetadata
+                                    entry = merged[type].setdefault(mitreid, {})
+                                    entry.setdefault('Metadata', objectmetadata)
                                     # Add the matrix to the ID
-                                    if 'Matrices' not in merged[type][mitreid]:
-                                        merged[type][mitreid]['Matrices'] = {}
-                                    if not matrix in merged[type][mitreid]['Matrices']:
-                                        merged[type][mitreid]['Matrices'][matrix] = merged['Matrices'][matrix]['Metadata']
-                                    merged[type]['UIDs'][uid] = mitreid
+                                    entry.setdefault('Matrices', {}).setdefault(matrix, matrixmetadata)
+                                    uids[uid] = (type, mitreid)
                 except:
                     print("Failed to parse a YAML object:")
                     pprint.pprint(object)
                     raise
-            if matrixtype == 'stix-json':
-                with open(matrixfile, 'r') as f:
-                    contents = json.loads(f.read())
-                    if 'objects' in contents:
-                        objecttype = 'type'
-                        objects = contents['objects']
+            elif matrixtype == 'stix-json':
+                # Only the bundle's objects are needed, don't keep the rest alive
+                with open(matrixfile, 'rb') as f:
+                    objects = orjson.loads(f.read()).get('objects', [])
+                relationships = []
+                parsed[matrix] = relationships
                 try:
-                    # Create all objects
+                    # Create all objects, setting aside the relationships
                     for object in objects:
-                        if object[objecttype] in typemap:
-                            type = typemap[object[objecttype]]
+                        objecttype = object['type']
+                        type = typemap.get(objecttype)
+                        if objecttype == 'relationship':
+                            # Only the endpoints are needed to link the entities later
+                            if object.get('revoked', False) and not options.revoked:
+                                continue
+                            if object.get('x_mitre_deprecated', False) and not options.deprecated:
+                                continue
+                            relationships.append((object['source_ref'], object['target_ref']))
+                        elif type:
                             objectnames = []
                             objectdescriptions = []
                             objecturls = []
-                            objectmetadata = {
-                                'names': objectnames,
-                                'descriptions': objectdescriptions,
-                                'urls': objecturls,
-                            }
                             uid = object['id']
                             mitreid = None
-                            revoked = False
-                            deprecated = False
+                            revoked = object.get('revoked', False)
+                            deprecated = object.get('x_mitre_deprecated', False)
+                            if (revoked and not options.revoked) or (deprecated and not options.deprecated):
+                                # Left out of the UID index, so its relationships are skipped as well
+                                continue
                             if 'description' in object:
                                 objectdescriptions.append(object['description'])
-                            if 'revoked' in object:
-                                revoked = object['revoked']
-                            if 'x_mitre_deprecated' in object:
-                                deprecated = object['x_mitre_deprecated']
-                            if 'external_references' in object:
-                                for external_reference in object['external_references']:
-                                    if 'external_id' in external_reference:
-                                        if 'mitre' in external_reference['source_name']:
-                                            mitreid = external_reference['external_id']
-                                            if 'name' in object:
-                                                objectnames.append(object['name'])
-                                            if 'aliases' in object:
-                                                for alias in object['aliases']:
-                                                    if alias not in objectnames:
-                                                        objectnames.append(alias)
-                                            if 'description' in object:
-                                                if object['description'] not in objectdescriptions:
-                                                    objectdescriptions.append(object['description'])
-                                            if 'url' in external_reference:
-                                                objecturls.append(external_reference['url'])
+                            for external_reference in object.get('external_references', ()):
+                                if 'external_id' in external_reference:
+                                    if external_reference['source_name'] in mitresources:
+                                        mitreid = external_reference['external_id']
+                                        if 'url' in external_reference:
+                                            objecturls.append(external_reference['url'])
+                                        # Objects carry a single ATT&CK ID, the rest are citations
+                                        break
+                            # Names only need to be collected once, not per MITRE reference
+                            if mitreid:
+                                if 'name' in object:
+                                    objectnames.append(object['name'])
+                                # Deduplicate the aliases while keeping their order
+                                objectnames = list(dict.fromkeys(objectnames + object.get('aliases', [])))
                             if revoked:
                                 objectdescriptions.append('Note: This MITRE ID has been **revoked** and should no longer be used.\n')
                             if deprecated:
                                 objectdescriptions.append('Note: This MITRE ID has been **deprecated** and should no longer be used.\n')
-                            if not mitreid in merged[type]:
-                                merged[type][mitreid] = {}
-                            merged[type][mitreid]['Metadata'] = {
+                            entry = merged[type].setdefault(mitreid, {})
+                            entry['Metadata'] = {
                                 'name': objectnames,
                                 'description': objectdescriptions,
                                 'url': objecturls,
                             }
                             # Add the matrix to the ID
-                            if 'Matrices' not in merged[type][mitreid]:
-                                merged[type][mitreid]['Matrices'] = {}
-                            if not matrix in merged[type][mitreid]['Matrices']:
-                                merged[type][mitreid]['Matrices'][matrix] = merged['Matrices'][matrix]['Metadata']
+                            entry.setdefault('Matrices', {}).setdefault(matrix, matrixmetadata)
                             # Add the UID to the list
-                            merged[type]['UIDs'][uid] = mitreid
+                            uids[uid] = (type, mitreid)
                 except:
                     print("Failed to parse a JSON object:")
                     pprint.pprint(object)
                     raise
+                # Only the relationship endpoints are kept: free the parsed
+                # bundle before the next matrix is loaded
+                del objects
     # Build the relationships between MITRE IDs
-    for matrix in Matrices:
-        matrixfile = pathlib.Path(options.cachedir+'/'+Matrices[matrix]['file'])
-        if not matrixfile.exists():
-            # Missing ATT&CK matrix file
-            continue
-        else:
-            matrixname = Matrices[matrix]['name']
-            matrixdescription = Matrices[matrix]['description']
-            matrixtype = Matrices[matrix]['type']
-            matrixurl = Matrices[matrix]['url']
-            if matrixtype == 'unprotectit':
-                with open(matrixfile, 'r') as f:
-                    contents = json.loads(f.read())
-                    if 'techniques' in contents:
-                        objects = contents['techniques']
-                try:
-                    # Link all objects
-                    for object in objects:
-                        ids = object['unprotect_id'].replace(' ','').split(',')
-                        for id in ids:
-                            if id.startswith('T') or id.startswith('U'):
-                                try:
-                                    sourcetype = 'Techniques'
-                                    sourcemitreid = id
-                                    source = merged[sourcetype][sourcemitreid]
-                                    subobject = 1
-                                    if 'snippets' in object:
-                                        for snippet in object['snippets']:
-                                            targetmitresubid = 'CS' + sourcemitreid[1:] + '.' + str(subobject).zfill(3)
-                                            targettype = 'Code Snippets'
-                                            subobject += 1
-                                            target = merged[targettype][targetmitresubid]
-                                            if not targettype in source:
-                                                source[targettype] = {}
-                                            source[targettype][targetmitresubid] = target['Metadata']
-                                            if not sourcetype in target:
-                                                target[sourcetype] = {}
-                                            target[sourcetype][sourcemitreid] = source['Metadata']
-                                    subobject = 1
-                                    if 'detection_rules' in object:
-                                        for detection_rule in object['detection_rules']:
-                                            targetmitresubid = 'DR' + sourcemitreid[1:] + '.' + str(subobject).zfill(3)
-                                            targettype = 'Detection Rules'
-                                            subobject += 1
-                                            target = merged[targettype][targetmitresubid]
-                                            if not targettype in source:
-                                                source[targettype] = {}
-                                            source[targettype][targetmitresubid] = target['Metadata']
-                                            if not sourcetype in target:
-                                                target[sourcetype] = {}
-                                            target[sourcetype][sourcemitreid] = source['Metadata']
-                                except:
-                                    print("Failed to build a relationship between:")
-                                    print(sourcetype+'/'+sourcemitreid,'->',targettype+'/'+targetmitresubid)
-                                    raise
-                except:
-                    print("Failed to parse a Unprotect.it object:")
-                    pprint.pprint(object)
-                    raise
-            if matrixtype == 'yaml':
-                with open(matrixfile, 'r') as f:
-                    objects = yaml.safe_load(f.read())
-                try:
-                    # Link all objects
-                    for type in objects:
-                        if type in typemap:
+    for matrix in parsed:
+        matrixtype = Matrices[matrix]['type']
+        objects = parsed[matrix]
+        if matrixtype == 'unprotectit':
+            try:
+                # Link all objects
+                for object in objects:
+                    ids = object['unprotect_id'].replace(' ','').split(',')
+                    for id in ids:
+                        if id.startswith('T') or id.startswith('U'):
                             try:
-                                sourcetype = typemap[type]
-                                for object in objects[type]:
-                                    sourcemitreid = object['id'].upper().replace('FG','').replace('ID','')
-                                    for subtree in object:
-                                        if subtree in typemap:
-                                            targettype = typemap[subtree]
-                                            uids = object[subtree]
-                                            if len(uids):
-                                                for uid in uids:
-                                                    if isinstance(uid,dict):
-                                                        for item in uid:
-                                                            if item in hashmap:
-                                                                targetmitreid = uid[item].upper().replace('FG','').replace('ID','')
-                                                    else:
-                                                        targetmitreid = uid.upper().replace('FG','').replace('ID','')
-                                                    source = merged[sourcetype][sourcemitreid]
-                                                    target = merged[targettype][targetmitreid]
-                                                    if not targettype in source:
-                                                        source[targettype] = {}
-                                                    source[targettype][targetmitreid] = target['Metadata']
-                                                    if not sourcetype in target:
-                                                        target[sourcetype] = {}
-                                                    target[sourcetype][sourcemitreid] = source['Metadata']
+                                sourcetype = 'Techniques'
+                                sourcemitreid = id
+                                source = merged[sourcetype][sourcemitreid]
+                                subobject = 1
+                                if 'snippets' in object:
+                                    for snippet in object['snippets']:
+                                        targetmitresubid = 'CS' + sourcemitreid[1:] + '.' + str(subobject).zfill(3)
+                                        targettype = 'Code Snippets'
+                                        subobject += 1
+                                        target = merged[targettype][targetmitresubid]
+                                        source.setdefault(targettype, {})[targetmitresubid] = target['Metadata']
+                                        target.setdefault(sourcetype, {})[sourcemitreid] = source['Metadata']
+                                subobject = 1
+                                if 'detection_rules' in object:
+                                    for detection_rule in object['detection_rules']:
+                                        targetmitresubid = 'DR' + sourcemitreid[1:] + '.' + str(subobject).zfill(3)
+                                        targettype = 'Detection Rules'
+                                        subobject += 1
+                                        target = merged[targettype][targetmitresubid]
+                                        source.setdefault(targettype, {})[targetmitresubid] = target['Metadata']
+                                        target.setdefault(sourcetype, {})[sourcemitreid] = source['Metadata']
                             except:
                                 print("Failed to build a relationship between:")
-                                print(sourcetype+'/'+sourcemitreid,'->',targettype+'/'+targetmitreid)
+                                print(sourcetype+'/'+sourcemitreid,'->',targettype+'/'+targetmitresubid)
                                 raise
-                except:
-                    print("Failed to parse a YAML object:")
-                    pprint.pprint(object)
-                    raise
-            if matrixtype == 'stix-json':
-                with open(matrixfile, 'r') as f:
-                    objects = json.loads(f.read())['objects']
-                try:
-                    # Create all relationships
-                    for object in objects:
-                        if not object['type'] in typemap:
-                            type = object['type']
-                            if type == 'relationship':
-                                try:
-                                    sourceuid = object['source_ref']
-                                    sourcemitretype = sourceuid.split('--')[0]
-                                    targetuid = object['target_ref']
-                                    targetmitretype = targetuid.split('--')[0]
-                                    if sourcemitretype in typemap and targetmitretype in typemap:
-                                        sourcetype = typemap[sourcemitretype]
-                                        sourcemitreid = merged[sourcetype]['UIDs'][sourceuid]
-                                        source = merged[sourcetype][sourcemitreid]
-                                        targettype = typemap[targetmitretype]
-                                        targetmitreid = merged[targettype]['UIDs'][targetuid]
-                                        target = merged[targettype][targetmitreid]
-                                        if not targettype in source:
-                                            source[targettype] = {}
-                                        source[targettype][targetmitreid] = target['Metadata']
-                                        if not sourcetype in target:
-                                            target[sourcetype] = {}
-                                        target[sourcetype][sourcemitreid] = source['Metadata']
-                                except KeyError:
-                                    print("Failed to build a relationship between:")
-                                    #print(sourcetype+'/'+sourcemitreid,'->',targettype+'/'+targetmitreid)
-                                    print(sourcemitreid)
-                                    pprint.pprint(source)
-                                    print(targetmitreid)
-                                    pprint.pprint(target)
-                                    raise
-                except:
-                    print("Failed to parse JSON object:")
-                    pprint.pprint(object)
-                    raise
-    for category in categories:
-        if 'UIDs' in merged[category]:
-            del merged[category]['UIDs']
+            except:
+                print("Failed to parse a Unprotect.it object:")
+                pprint.pprint(object)
+                raise
+        elif matrixtype == 'yaml':
+            try:
+                # Link all objects
+                for type in objects:
+                    sourcetype = typemap.get(type)
+                    if sourcetype:
+                        try:
+                            for object in objects[type]:
+                                sourcemitreid = fightID(object['id'])
+                                for subtree in object:
+                                    targettype = typemap.get(subtree)
+                                    if targettype:
+                                        refs = object[subtree]
+                                        if len(refs):
+                                            for uid in refs:
+                                                if isinstance(uid,dict):
+                                                    for item in uid:
+                                                        if item in hashmap:
+                                                            targetmitreid = fightID(uid[item])
+                                                else:
+                                                    targetmitreid = fightID(uid)
+                                                source = merged[sourcetype][sourcemitreid]
+                                                target = merged[targettype][targetmitreid]
+                                                source.setdefault(targettype, {})[targetmitreid] = target['Metadata']
+                                                target.setdefault(sourcetype, {})[sourcemitreid] = source['Metadata']
+                        except:
+                            print("Failed to build a relationship between:")
+                            print(sourcetype+'/'+sourcemitreid,'->',targettype+'/'+targetmitreid)
+                            raise
+            except:
+                print("Failed to parse a YAML object:")
+                pprint.pprint(object)
+                raise
+        elif matrixtype == 'stix-json':
+            try:
+                # Create all relationships
+                for object in objects:
+                    sourceuid, targetuid = object
+                    # Only link objects that were created as entities
+                    if sourceuid in uids and targetuid in uids:
+                        sourcetype, sourcemitreid = uids[sourceuid]
+                        source = merged[sourcetype][sourcemitreid]
+                        targettype, targetmitreid = uids[targetuid]
+                        target = merged[targettype][targetmitreid]
+                        source.setdefault(targettype, {})[targetmitreid] = target['Metadata']
+                        target.setdefault(sourcetype, {})[sourcemitreid] = source['Metadata']
+            except:
+                print("Failed to parse JSON object:")
+                pprint.pprint(object)
+                raise
     return merged
 
-def DownloadMatrices(options):
+def checkCache(options):
+    '''
+    Return whether the cachefile exists and parses, so the CLI can replace a
+    truncated or corrupt one before any API worker loads it
+    '''
+    try:
+        orjson.loads(pathlib.Path(options.cachefile).read_bytes())
+        return True
+    except (ValueError, FileNotFoundError):
+        return False
+
+
+def UpdateCache(options):
+    '''
+    Generate the cachefile from the downloaded matrices, unless none of the
+    inputs (matrix files, matrix table, settings and this script) changed
+    since the cachefile was last generated
+    '''
+    cachefile = pathlib.Path(options.cachefile)
+    digestfile = pathlib.Path(options.cachefile + '.sha256')
+    digest = hashlib.sha256()
+    digest.update(pathlib.Path(__file__).read_bytes())
+    digest.update(repr((Matrices, options.deprecated, options.revoked)).encode())
     for matrix in Matrices:
-        file, url = options.cachedir+'/'+Matrices[matrix]['file'], Matrices[matrix]['url']
-        jsonfile = pathlib.Path(file)
-        if Matrices[matrix]['type'] in ('stix-json', 'yaml'):
-            if not jsonfile.exists() or options.force:
-                try:
-                    logging.info('Downloading ' + url)
-                    with urllib.request.urlopen(url) as response, open(jsonfile, 'wb') as outfile:
-                        shutil.copyfileobj(response, outfile)
-                except urllib.error.HTTPError as e:
-                    logging.error('Download of ' + url + ' failed: ' + e.reason)
-        if Matrices[matrix]['type'] in ('unprotectit',):
-            if not jsonfile.exists() or options.force:
-                try:
-                    page = 1
-                    techniques = {'techniques': []}
-                    logging.info('Downloading ' + url + ' page ' + str(page))
-                    with requests.get(url, headers={'Content-Type': 'application/json'}) as response:
-                        json_response = response.json()
-                        if 'count' in json_response:
-                            if 'results' in json_response:
-                                results = json_response['results']
-                                for result in results:
-                                    techniques['techniques'].append(result)
-                            # Grab the next pages as well (if they exist)
-                            if 'next' in json_response:
-                                nextpage = json_response['next']
-                                while nextpage:
-                                    logging.info('Downloading ' + url + ' page ' + str(nextpage))
-                                    with requests.get(nextpage, headers={'Content-Type': 'application/json'}) as response:
-                                        json_response = response.json()
-                                        if 'count' in json_response:
-                                            if 'results' in json_response:
-                                                results = json_response['results']
-                                                for result in results:
-                                                    techniques['techniques'].append(result)
-                                                if 'next' in json_response:
-                                                    nextpage = json_response['next']
-                    if len(techniques):
-                        with open(file, mode='w') as f:
-                            cache = json.dumps(techniques)
-                            f.write(cache)
-                            text = "Unprotect.it cache rebuilt."
-                            return {'messages': [
-                                {'text': text},
-                            ]}
-                except urllib.error.HTTPError as e:
+        matrixfile = pathlib.Path(options.cachedir+'/'+Matrices[matrix]['file'])
+        if matrixfile.exists():
+            digest.update(matrix.encode())
+            digest.update(matrixfile.read_bytes())
+    digest = digest.hexdigest()
+    if cachefile.exists() and digestfile.exists() and digestfile.read_text() == digest:
+        if checkCache(options):
+            if options.verbose:
+                logging.info('Matrices unchanged, keeping the cachefile: ' + cachefile.name)
+            return
+        logging.warning('Corrupt cachefile ' + cachefile.name + ', regenerating')
+    cache = GenerateMatrix(options)
+    # Write to a uniquely named temporary file and swap it in, so neither a
+    # crash mid-write nor a concurrent run can leave a truncated cachefile
+    with tempfile.NamedTemporaryFile(dir=cachefile.parent, prefix=cachefile.name + '.', suffix='.tmp',
+                                     delete=False) as tmpfile:
+        try:
+            # Written once, loaded by every API worker: orjson's output is
+            # compact and non-str keys are stringified the way json.dump() did
+            tmpfile.write(orjson.dumps(cache, option=orjson.OPT_NON_STR_KEYS))
+        except BaseException:
+            os.unlink(tmpfile.name)
+            raise
+    # NamedTemporaryFile() creates it owner-only, give it open()'s mode
+    os.chmod(tmpfile.name, 0o666 & ~umask)
+    os.replace(tmpfile.name, cachefile)
+    digestfile.write_text(digest)
+
+
+def DownloadMatrices(options):
+    '''
+    Download all matrices concurrently: every download is network-bound and
+    writes its own file, so the total time is that of the slowest one
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(Matrices)) as executor:
+        # Consume the results, so a failed download still raises
+        list(executor.map(functools.partial(DownloadMatrix, options), Matrices))
+
+
+def DownloadMatrix(options, matrix):
+    file, url = options.cachedir+'/'+Matrices[matrix]['file'], Matrices[matrix]['url']
+    jsonfile = pathlib.Path(file)
+    if Matrices[matrix]['type'] in ('stix-json', 'yaml'):
+        if not jsonfile.exists() or options.force:
+            # Ask for a compressed response, and only for a new one if
+            # the matrix is already on disk: unchanged matrices get a 304
+            headers = {'Accept-Encoding': 'gzip'}
+            metafile = pathlib.Path(file + '.meta')
+            if jsonfile.exists():
+                meta = orjson.loads(metafile.read_bytes()) if metafile.exists() else {}
+                headers['If-Modified-Since'] = meta.get('Last-Modified') or \
+                    email.utils.formatdate(jsonfile.stat().st_mtime, usegmt=True)
+                if 'ETag' in meta:
+                    headers['If-None-Match'] = meta['ETag']
+            try:
+                logging.info('Downloading ' + url)
+                request = urllib.request.Request(url, headers=headers)
+                with urllib.request.urlopen(request) as response:
+                    stream = response
+                    if response.headers.get('Content-Encoding') == 'gzip':
+                        stream = gzip.GzipFile(fileobj=response)
+                    # Download next to the matrix and only swap it in once
+                    # complete: a truncated matrix would otherwise be kept
+                    # forever, as the server answers 304 to its metadata
+                    with tempfile.NamedTemporaryFile(dir=jsonfile.parent, prefix=jsonfile.name + '.',
+                                                     suffix='.tmp', delete=False) as outfile:
+                        try:
+                            shutil.copyfileobj(stream, outfile, length=1024*1024)
+                            # A connection closed early just ends the stream,
+                            # with part of the Content-Length still unread
+                            if response.length:
+                                raise http.client.IncompleteRead(b'', response.length)
+                        except BaseException:
+                            os.unlink(outfile.name)
+                            raise
+                    os.chmod(outfile.name, 0o666 & ~umask)
+                    os.replace(outfile.name, jsonfile)
+                    metafile.write_bytes(orjson.dumps({header: response.headers[header]
+                                                       for header in ('Last-Modified', 'ETag')
+                                                       if header in response.headers}))
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    logging.info('Not modified, keeping ' + jsonfile.name)
+                else:
                     logging.error('Download of ' + url + ' failed: ' + e.reason)
+    if Matrices[matrix]['type'] in ('unprotectit',):
+        if not jsonfile.exists() or options.force:
+            try:
+                page = 1
+                techniques = {'techniques': []}
+                logging.info('Downloading ' + url + ' page ' + str(page))
+                with requests.get(url, headers={'Content-Type': 'application/json'}) as response:
+                    json_response = response.json()
+                    if 'count' in json_response:
+                        if 'results' in json_response:
+                            techniques['techniques'].extend(json_response['results'])
+                        # Grab the next pages as well (if they exist)
+                        if 'next' in json_response:
+                            nextpage = json_response['next']
+                            while nextpage:
+                                logging.info('Downloading ' + url + ' page ' + str(nextpage))
+                                with requests.get(nextpage, headers={'Content-Type': 'application/json'}) as response:
+                                    json_response = response.json()
+                                    if 'count' in json_response:
+                                        if 'results' in json_response:
+                                            techniques['techniques'].extend(json_response['results'])
+                                            if 'next' in json_response:
+                                                nextpage = json_response['next']
+                if len(techniques):
+                    with open(file, mode='w') as f:
+                        cache = json.dumps(techniques)
+                        f.write(cache)
+                        text = "Unprotect.it cache rebuilt."
+                        return {'messages': [
+                            {'text': text},
+                        ]}
+            except urllib.error.HTTPError as e:
+                logging.error('Download of ' + url + ' failed: ' + e.reason)
 
 
 if __name__ == "__main__":
@@ -833,8 +1056,8 @@ if __name__ == "__main__":
                         dest='force',
                         action='store_true',
                         default=options.force,
-                        help='[optional] Redownload the matrices and overwrite '
-                             'the cache file (clean run).')
+                        help='[optional] Redownload the matrices that changed upstream and '
+                             'regenerate the cache file if any input changed.')
     parser.add_argument('-d', '--daemonize',
                         dest='daemonize',
                         action='store_true',
@@ -847,27 +1070,33 @@ if __name__ == "__main__":
                         default=options.ip,
                         required=False,
                         help='[optional] Host the daemon should listen '
-                             'on (default: ' + options.ip + ').')
+                             f'on (default: {options.ip}).')
     parser.add_argument('-p', '--port',
                         dest='port',
                         default=options.port,
                         required=False,
                         help='[optional] Port the daemon should listen '
-                             'on (default: ' + str(options.port) + ').')
+                             f'on (default: {options.port}).')
+    parser.add_argument('-w', '--workers',
+                        dest='workers',
+                        type=int,
+                        default=getattr(options, 'workers', None) or 1,
+                        required=False,
+                        help='[optional] Number of API worker processes, each with its own copy of the cache '
+                             f'(default: {getattr(options, "workers", None) or 1}).')
     parser.add_argument('-n', '--numttpmatch',
                         dest='numttpmatch',
                         default=options.numttpmatch,
                         required=False,
                         help='[optional] Minimum number of TTPs to match '
                              'to actors (for the \'findactor\' feature) '
-                             '(default: ' + str(options.numttpmatch) + ').')
+                             f'(default: {options.numttpmatch}).')
     parser.add_argument('-k', '--key',
                         dest='token',
                         default=options.token,
                         required=False,
                         help='[optional] Block all web access unless a '
-                             'valid token is offered (default: ' +
-                             str(options.token) + ').')
+                             f'valid token is offered (default: {options.token}).')
     parser.add_argument('-v', '--verbose',
                         dest='verbose',
                         action='store_true',
@@ -878,18 +1107,16 @@ if __name__ == "__main__":
     parser.add_argument('-l', '--logfile',
                         dest='logfile',
                         default=options.logfile,
-                        help='[optional] Logfile for log output (default: \'' +
-                             options.logfile + '\')')
+                        help=f'[optional] Logfile for log output (default: \'{options.logfile}\')')
     parser.add_argument('-m', '--cachedir',
                         dest='cachedir',
                         default=options.cachedir,
-                        help='[optional] Directory for cache (default: \'' +
-                             options.cachedir + '\')')
+                        help=f'[optional] Directory for cache (default: \'{options.cachedir}\')')
     parser.add_argument('-c', '--cachefile',
                         dest='cachefile',
                         default=options.cachefile,
-                        help='[optional] Filename for cache (default: \'' +
-                             options.cachefile + '\')')
+                        help=f'[optional] Filename for cache (default: \'{options.cachefile}\')')
+    parser.set_defaults(deprecated=options.deprecated, revoked=options.revoked)
     options = parser.parse_args()
     logging.basicConfig(filename=options.logfile, level=logging.INFO)
     cachefile = pathlib.Path(options.cachefile)
@@ -897,28 +1124,27 @@ if __name__ == "__main__":
         if options.verbose:
             logging.info('Generating the cachefile: ' + cachefile.name)
         DownloadMatrices(options)
-        cache = GenerateMatrix(options)
-        with open(cachefile, 'w') as newcachefile:
-            json.dump(cache, newcachefile)
+        UpdateCache(options)
     if not options.daemonize:
         parser.print_help()
     else:
         cachefile = pathlib.Path(options.cachefile)
-        if not cachefile.exists():
+        # A missing or corrupt cachefile is (re)generated here, once, rather
+        # than by every API worker on startup
+        if not checkCache(options):
             if options.verbose:
-                logging.info('Loading the cachefile: ' + cachefile.name)
+                logging.info('Generating the cachefile: ' + cachefile.name)
             DownloadMatrices(options)
-            cache = GenerateMatrix(options)
-            with open(cachefile, 'w') as cachefile:
-                json.dump(cache, cachefile)
-        else:
-            with open(cachefile, 'r') as cachefile:
-                cache = json.load(cachefile)
+            UpdateCache(options)
+        # The cachefile is parsed once by the API process itself on startup
+        import uvicorn
         try:
             port = int(options.port)
         except ValueError:
             logging.error('The listening port must be a numeric value')
-        uvicorn.run('attackmatrix:app', host=options.ip, port=options.port, log_level='info', reload=False)
+            sys.exit(1)
+        uvicorn.run('attackmatrix:app', host=options.ip, port=port, log_level='info', reload=False,
+                    loop='auto', http='auto', workers=options.workers)
 else:
     '''
     Module import: GenerateMatrix() to get a Python dict